@@ -15,6 +15,17 @@ class PSQLItemMeta:
     match_fields: tuple[str] = ()  # for updating
     substitutions: dict[str, Substitution] = {}
     do_update: bool = True
+    save_order: int = 0  # lower saved first, so rows referenced by foreign keys already exist
+    self_reference_fields: tuple[str] = ()  # foreign keys to the same table
+
+    # membership lookups for the pipeline, filled for every Meta subclass
+    match_fields_set: frozenset[str] = frozenset()
+    substitution_fields: frozenset[str] = frozenset()
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls.match_fields_set = frozenset(cls.match_fields)
+        cls.substitution_fields = frozenset(cls.substitutions)
 
     def __init__(self):
         assert self.db_table and self.fields
@@ -30,18 +41,21 @@ class CategoryItem(scrapy.Item):
         db_table = "products_category"
         fields = ("id", "name", "parent_id", "level")
         match_fields = ("id",)
+        self_reference_fields = ("parent_id",)
         to_update = False
 
 
-class TagItem(scrapy.Item):
-    id = scrapy.Field()
-    name = scrapy.Field()
-    group_id = scrapy.Field()
+@dataclass(slots=True)
+class TagItem:
+    id: str = None
+    name: str = None
+    group_id: str = None
 
     class Meta(PSQLItemMeta):
         db_table = "products_tag"
         fields = ("id", "name", "group_id")
         match_fields = ("id",)
+        self_reference_fields = ("group_id",)
         do_update = False
 
 
@@ -72,37 +86,42 @@ class ProductItem(scrapy.Item):
         match_fields = ("id",)
 
 
-class ProductCategoryItem(scrapy.Item):
-    product_id = scrapy.Field()
-    category_id = scrapy.Field()
+@dataclass(slots=True)
+class ProductCategoryItem:
+    product_id: str = None
+    category_id: str = None
 
     class Meta(PSQLItemMeta):
         db_table = "products_product_categories"
         fields = ("product_id", "category_id")
         match_fields = ("product_id", "category_id")
         do_update = False
+        save_order = 1
 
 
-class ProductImageItem(scrapy.Item):
-    product_id = scrapy.Field()
-    url = scrapy.Field()
+@dataclass(slots=True)
+class ProductImageItem:
+    product_id: str = None
+    url: str = None
 
     class Meta(PSQLItemMeta):
         db_table = "products_productimage"
         fields = ("product_id", "url")
         match_fields = ("product_id", "url")
+        save_order = 1
 
 
-class ProductInventoryItem(scrapy.Item):
-    id = scrapy.Field()
-    product_id = scrapy.Field()
-    item_code = scrapy.Field()
-    site_price = scrapy.Field()
-    product_url = scrapy.Field()
-    name = scrapy.Field()
-    quantity = scrapy.Field()
-    status_code = scrapy.Field()
-    color_image = scrapy.Field()
+@dataclass(slots=True)
+class ProductInventoryItem:
+    id: str = None
+    product_id: str = None
+    item_code: str = None
+    site_price: float = None
+    product_url: str = None
+    name: str = None
+    quantity: int = None
+    status_code: str = None
+    color_image: str = None
 
     class Meta(PSQLItemMeta):
         db_table = "products_productinventory"
@@ -118,23 +137,26 @@ class ProductInventoryItem(scrapy.Item):
             "color_image"
         )
         match_fields = ("id",)
+        save_order = 1
 
 
-class ProductInventoryTagItem(scrapy.Item):
-    productinventory_id = scrapy.Field()
-    tag_id = scrapy.Field()
+@dataclass(slots=True)
+class ProductInventoryTagItem:
+    productinventory_id: str = None
+    tag_id: str = None
 
     class Meta(PSQLItemMeta):
         db_table = "products_productinventory_tags"
         fields = ("productinventory_id", "tag_id")
         match_fields = ("productinventory_id", "tag_id")
         do_update = False
+        save_order = 2
 
 
 class ProductToRemoveItem(scrapy.Item):
     id = scrapy.Field()
 
     class Meta(PSQLItemMeta):
-        db_table = "products_productinventory_tags"
-        fields = ("product_id",)
+        db_table = "products_product"
+        fields = ("id",)
 
@@ -1,15 +1,17 @@
-from collections import OrderedDict
+import io
+from collections import defaultdict
 from dataclasses import dataclass
-from typing import Any
+from typing import Any, Callable
 
 import psycopg2
+from itemadapter import ItemAdapter
 from psycopg2.extras import execute_values
 
 from kaimono.items import PSQLItemMeta
 from kaimono.settings import DATABASE_SETTINGS
 
 
-@dataclass
+@dataclass(slots=True)
 class DistributedData:
     fields: list = None
     to_update: list = None
@@ -17,62 +19,116 @@ class DistributedData:
 
 
 class PSQLPipeline:
-    SQL_INSERT = "INSERT INTO {table_name} ({fields}) VALUES %s"
+    SQL_COPY = "COPY {table_name} ({fields}) FROM STDIN WITH (FORMAT CSV, DELIMITER E'\\t', NULL '')"
     SQL_UPDATE = "UPDATE {table_name} SET {field_sets} FROM (VALUES %s) as tmp ({fields}) WHERE {condition}"
-    SQL_EXISTS = "SELECT EXISTS (SELECT 1 FROM {table_name} WHERE {condition})"
     SQL_SELECT_ALL = "SELECT {fields} FROM {table_name}"
     SQL_SELECT_ONE = "SELECT {fields} FROM {table_name} WHERE {match_field} = %s"
     SQL_SELECT_CONDITION = "SELECT {fields} FROM {table_name} WHERE {condition}"
+    SQL_SELECT_EXISTING = "SELECT {fields} FROM {table_name} WHERE ({fields}) IN (VALUES %s)"
     
+    BATCH_SIZE = 500
+    PAGE_SIZE = 500  # rows per statement sent by execute_values
+
     def __init__(self):
         self.conn = None
         self.cur = None
         self.logger = None
+        self.buffers = None
+        self.sql_cache = None
 
     def open_spider(self, spider):
         self.conn = psycopg2.connect(**DATABASE_SETTINGS)
         self.cur = self.conn.cursor()
         self.logger = spider.logger
+        self.buffers = defaultdict(list)
+        self.sql_cache = {}
 
     def close_spider(self, spider):
         spider.logger.debug(f'{self.__class__.__name__} close...')
-        self.cur.close()
-        self.conn.close()
+        try:
+            self.flush()
+        finally:
+            self.cur.close()
+            self.conn.close()
 
     def process_item(self, item, spider):
         if not hasattr(item, 'Meta') or not issubclass(getattr(item, 'Meta'), PSQLItemMeta):
             spider.logger.debug(f'{self.__class__.__name__} passed item...')
             return item
 
-        db_meta = item.Meta
-        distributed_data = self.distribute_data(item)
-        if distributed_data.to_create:
-            self.create(
-                table_name=db_meta.db_table,
-                fields=distributed_data.fields,
-                values=distributed_data.to_create
-            )
-        if distributed_data.to_update:
-            self.update(
-                table_name=db_meta.db_table,
-                fields=distributed_data.fields,
-                match_fields=db_meta.match_fields,
-                values=distributed_data.to_update
-            )
+        self.buffers[type(item)].append(item)
+        if sum(map(len, self.buffers.values())) >= self.BATCH_SIZE:
+            self.flush()
         return item
 
-    def distribute_data(self, item) -> DistributedData:
-        db_meta = item.Meta
+    def flush(self) -> None:
+        for item_cls in sorted(self.buffers, key=lambda cls: cls.Meta.save_order):
+            items = self.buffers[item_cls]
+            if not items:
+                continue
+
+            self.buffers[item_cls] = []
+            try:
+                self.save(item_cls.Meta, items)
+            except Exception:
+                # a single bad row fails its whole statement, so the batch is saved again item by item
+                # to lose only that row; rows saved before the failure are matched as existing ones
+                for item in items:
+                    try:
+                        self.save(item_cls.Meta, [item])
+                    except Exception as e:
+                        self.logger.error(f"Dropped {item_cls.__name__} {ItemAdapter(item).asdict()}: {e}")
+
+    def save(self, db_meta, items: list) -> None:
+        for data in self.merge_items(db_meta, items):
+            distributed_data = self.distribute_data(db_meta, data)
+            if distributed_data.to_create:
+                self.create(
+                    table_name=db_meta.db_table,
+                    fields=distributed_data.fields,
+                    values=distributed_data.to_create
+                )
+            if distributed_data.to_update:
+                self.update(
+                    table_name=db_meta.db_table,
+                    fields=distributed_data.fields,
+                    match_fields=db_meta.match_fields,
+                    values=distributed_data.to_update
+                )
+
+    @staticmethod
+    def merge_items(db_meta, items: list) -> list[dict[str, list]]:
+        # items filled with different fields can't share rows, so they are merged per set of fields
+        merged = {}
+        for item in map(ItemAdapter, items):
+            row = {
+                field: value
+                for field, value in zip(db_meta.fields, map(item.get, db_meta.fields))
+                if value is not None
+            }
+            if not row:
+                continue
+
+            data = merged.setdefault(tuple(row), {field: [] for field in row})
+            for field, value in row.items():
+                data[field].append(value)
+        # rows without a parent (e.g. parent_id, group_id) go first, so the rows referencing them find them saved
+        return sorted(
+            merged.values(),
+            key=lambda data: sum(field in data for field in db_meta.self_reference_fields)
+        )
+
+    def distribute_data(self, db_meta, data: dict[str, list]) -> DistributedData:
         distributed_data = DistributedData(fields=[], to_create=[], to_update=[])
-        collected_data, checks_to_exists = [], OrderedDict()
+        collected_data, checks_to_exists = [], {}
 
         for field in db_meta.fields:
-            values = item.get(field)
+            values = data.get(field)
 
             if values is None:
                 continue
 
-            if field in db_meta.substitutions:
+            if field in db_meta.substitution_fields:
                 substitution = db_meta.substitutions[field]
 
                 # replacing values by matched ids
@@ -87,36 +143,46 @@ class PSQLPipeline:
             distributed_data.fields.append(field)
             collected_data.append(values)
 
-            if field in db_meta.match_fields:
+            if field in db_meta.match_fields_set:
                 checks_to_exists[field] = values
 
-        collected_data = list(zip(*collected_data))
+        # rows and their match values are consumed once, so they're zipped lazily instead of
+        # being transposed into intermediate lists
+        rows = zip(*collected_data)
 
         if not db_meta.match_fields:
-            distributed_data.to_create.extend(collected_data)
+            distributed_data.to_create.extend(rows)
             return distributed_data
 
-        # {field: [value, ...], field_2: [value_2, ...], ...}
+        existing_matches = self.select_existing(
+            table_name=db_meta.db_table,
+            match_fields=tuple(checks_to_exists.keys()),
+            values=list(set(zip(*checks_to_exists.values())))
+        )
         processed_matches = set()
 
-        for index, matches in enumerate(tuple(zip(*checks_to_exists.values()))):
+        # (value, value_2, ...) of match fields aligned with rows
+        for matches, row in zip(zip(*checks_to_exists.values()), rows):
             if matches in processed_matches:
                 continue
 
             processed_matches.add(matches)
-            data = collected_data[index]
-            checks = dict(zip(checks_to_exists.keys(), matches))
-
-            row_exists = self.check_exists(db_meta.db_table, **checks)
-            if row_exists:
-                if item.Meta.do_update is False:
+            if matches in existing_matches:
+                if db_meta.do_update is False:
                     continue
 
-                distributed_data.to_update.append(data)
+                distributed_data.to_update.append(row)
             else:
-                distributed_data.to_create.append(data)
+                distributed_data.to_create.append(row)
         return distributed_data
 
+    def cached_sql(self, key: tuple, build_sql: Callable[[], str]) -> str:
+        # the same tables are saved with the same sets of fields over the whole crawl
+        sql = self.sql_cache.get(key)
+        if sql is None:
+            sql = self.sql_cache[key] = build_sql()
+        return sql
+
     def match_ids(
         self,
         table_name: str,
@@ -128,9 +194,10 @@ class PSQLPipeline:
             sql = self.SQL_SELECT_CONDITION.format(
                 table_name=table_name,
                 fields=f"{pk_field}, {match_field}",
-                condition=f"{match_field} IN %s"
+                # a single array parameter keeps the query text the same for any number of values
+                condition=f"{match_field} = ANY(%s)"
             )
-            self.cur.execute(sql, (tuple(values),))
+            self.cur.execute(sql, (list(values),))
             result = self.cur.fetchall()
         except Exception as e:
             self.conn.rollback()
@@ -140,27 +207,57 @@ class PSQLPipeline:
             if not result:
                 return []
 
-            ids = [_id for value in values for _id, match in result if value == match]
+            ids_by_match = {match: _id for _id, match in result}
+            ids = [ids_by_match[value] for value in values if value in ids_by_match]
             assert len(ids) == len(values)
             return ids
 
-    def check_exists(self, table_name: str, **matches) -> bool:
+    def select_existing(
+        self,
+        table_name: str,
+        match_fields: tuple[str],
+        values: list[tuple[Any]]
+    ) -> set[tuple[Any]]:
+        if not values:
+            return set()
+
         try:
-            condition = " AND ".join([f"{field} = '{value}'" for field, value in matches.items()])
-            sql = self.SQL_EXISTS.format(table_name=table_name, condition=condition)
-            self.cur.execute(sql)
-            return bool(self.cur.fetchone()[0])
+            sql = self.cached_sql(
+                (self.SQL_SELECT_EXISTING, table_name, match_fields),
+                lambda: self.SQL_SELECT_EXISTING.format(
+                    table_name=table_name,
+                    fields=", ".join(match_fields)
+                )
+            )
+            result = execute_values(self.cur, sql, values, page_size=self.PAGE_SIZE, fetch=True)
         except Exception as e:
             self.conn.rollback()
-            self.logger.error(f"Failed to process item on check to exists: {e}")
+            self.logger.error(f"Failed to process item on select existing {e.__class__.__name__}: {e}")
+            raise e
+        else:
+            return set(map(tuple, result))
+
+    @staticmethod
+    def copy_value(value: Any | None) -> str:
+        # NULL is an unquoted empty field. Every other value is quoted, so strings such as "" or "\N" stay
+        # strings, and tabs, carriage returns and newlines in scraped texts can't break the row
+        if value is None:
+            return ""
+        return '"%s"' % str(value).replace('"', '""')
 
     def create(self, table_name, fields: list[str], values: list[tuple[Any | None]]) -> None:
+        buffer = io.StringIO()
+        buffer.writelines("\t".join(map(self.copy_value, row)) + "\n" for row in values)
+        buffer.seek(0)
         try:
-            sql = self.SQL_INSERT.format(
-                table_name=table_name,
-                fields=", ".join(fields)
+            sql = self.cached_sql(
+                (self.SQL_COPY, table_name, tuple(fields)),
+                lambda: self.SQL_COPY.format(
+                    table_name=table_name,
+                    fields=", ".join(fields)
+                )
             )
-            execute_values(self.cur, sql, values)
+            self.cur.copy_expert(sql, buffer)
             self.logger.debug("Saved to %s: %s" % (table_name, len(values)))
         except Exception as e:
             self.conn.rollback()
@@ -176,18 +273,19 @@ class PSQLPipeline:
         match_fields: tuple[str],
         values: list[tuple[Any | None]]
     ) -> None:
-        conditions = ' AND '.join(
-            [f"{table_name}.{match_field} = tmp.{match_field}" for match_field in match_fields]
-        )
-        field_sets = ', '.join([f'{field} = tmp.{field}' for field in fields])
         try:
-            sql = self.SQL_UPDATE.format(
-                table_name=table_name,
-                field_sets=field_sets,
-                fields=", ".join(fields),
-                condition=conditions
+            sql = self.cached_sql(
+                (self.SQL_UPDATE, table_name, tuple(fields), match_fields),
+                lambda: self.SQL_UPDATE.format(
+                    table_name=table_name,
+                    field_sets=', '.join([f'{field} = tmp.{field}' for field in fields]),
+                    fields=", ".join(fields),
+                    condition=' AND '.join(
+                        [f"{table_name}.{match_field} = tmp.{match_field}" for match_field in match_fields]
+                    )
+                )
             )
-            execute_values(self.cur, sql, values)
+            execute_values(self.cur, sql, values, page_size=self.PAGE_SIZE)
             self.logger.debug("Updated in %s: %s" % (table_name, len(values)))
         except Exception as e:
             self.conn.rollback()
@@ -198,22 +296,29 @@ class PSQLPipeline:
 
 
 class PSQLRemovePipeline:
-    SQL_SINGLE_DELETE = "DELETE FROM {table_name} WHERE {field} = %s"
+    SQL_DELETE = "DELETE FROM {table_name} WHERE {field} = ANY(%s)"
+
+    BATCH_SIZE = 10000  # ids bound as one array per statement
 
     def __init__(self):
         self.conn = None
         self.cur = None
         self.logger = None
+        self.buffers = None
 
     def open_spider(self, spider):
         self.conn = psycopg2.connect(**DATABASE_SETTINGS)
         self.cur = self.conn.cursor()
         self.logger = spider.logger
+        self.buffers = defaultdict(list)
 
     def close_spider(self, spider):
         spider.logger.debug(f'{self.__class__.__name__} close...')
-        self.cur.close()
-        self.conn.close()
+        try:
+            self.flush()
+        finally:
+            self.cur.close()
+            self.conn.close()
 
     def process_item(self, item, spider):
         if not hasattr(item, 'Meta') or not issubclass(getattr(item, 'Meta'), PSQLItemMeta):
@@ -221,17 +326,31 @@ class PSQLRemovePipeline:
             return item
 
         db_meta = item.Meta
-        field = db_meta.fields[0]
-        value = item.get(field)
+        value = ItemAdapter(item).get(db_meta.fields[0])
         if value:
-            self.single_delete(db_meta.db_table, field=field, value=value)
+            values = self.buffers[db_meta]
+            values.append(value)
+            if len(values) >= self.BATCH_SIZE:
+                self.flush()
+        return item
+
+    def flush(self) -> None:
+        for db_meta, values in self.buffers.items():
+            if not values:
+                continue
+
+            try:
+                self.delete(db_meta.db_table, field=db_meta.fields[0], values=values)
+            finally:
+                values.clear()
 
-    def single_delete(self, table_name, field, value):
+    def delete(self, table_name, field, values: list):
         try:
-            sql = self.SQL_SINGLE_DELETE.format(table_name=table_name, field=field)
-            execute_values(self.cur, sql, value)
+            sql = self.SQL_DELETE.format(table_name=table_name, field=field)
+            for i in range(0, len(values), self.BATCH_SIZE):
+                self.cur.execute(sql, (values[i:i + self.BATCH_SIZE],))
             self.conn.commit()
-            self.logger.info("DELETE in %s: %s" % (table_name, value))
+            self.logger.info("DELETE in %s: %s" % (table_name, len(values)))
         except Exception as e:
             self.conn.rollback()
             self.logger.error(f"Failed to process item on deleting: {e}")
@@ -31,6 +31,10 @@ USER_AGENT = (
 # Obey robots.txt rules
 ROBOTSTXT_OBEY = False
 
+# Threads running DNS lookups and database queries of the spiders. The pool is sized once per process,
+# so this can't be set in spider custom_settings
+REACTOR_THREADPOOL_MAXSIZE = 20
+
 # Configure maximum concurrent requests performed by Scrapy (default: 16)
 #CONCURRENT_REQUESTS = 32
 
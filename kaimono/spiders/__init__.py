@@ -2,3 +2,46 @@
 #
 # Please refer to the documentation for information on how to create and manage
 # your spiders.
+from threading import BoundedSemaphore
+
+from psycopg2.pool import ThreadedConnectionPool
+from scrapy.utils.defer import maybe_deferred_to_future
+from twisted.internet import threads
+
+from kaimono.settings import DATABASE_SETTINGS
+
+
+class PSQLPoolMixin:
+    psql_pool: ThreadedConnectionPool = None
+    psql_slots: BoundedSemaphore = None
+
+    @classmethod
+    def from_crawler(cls, crawler, *args, **kwargs):
+        spider = super().from_crawler(crawler, *args, **kwargs)
+        # queries run in the reactor thread pool, so a connection per thread lets them never wait for each other
+        spider.open_psql_pool(maxconn=crawler.settings.getint("REACTOR_THREADPOOL_MAXSIZE"))
+        return spider
+
+    def open_psql_pool(self, maxconn: int, minconn: int = 1) -> None:
+        self.psql_pool = ThreadedConnectionPool(minconn=minconn, maxconn=maxconn, **DATABASE_SETTINGS)
+        # getconn raises instead of waiting once the pool is exhausted, so queries wait for a free connection here
+        self.psql_slots = BoundedSemaphore(maxconn)
+
+    def closed(self, reason):
+        if self.psql_pool is not None:
+            self.psql_pool.closeall()
+
+    def pooled_query(self, query_func, *args, **kwargs):
+        with self.psql_slots:
+            conn = self.psql_pool.getconn()
+            try:
+                return query_func(conn, *args, **kwargs)
+            finally:
+                self.psql_pool.putconn(conn)
+
+    async def run_query(self, query_func, *args, **kwargs):
+        # psycopg2 calls are blocking, so they are run in the reactor thread pool
+        # to keep downloading and parsing of other responses going on meanwhile
+        return await maybe_deferred_to_future(
+            threads.deferToThread(self.pooled_query, query_func, *args, **kwargs)
+        )
@@ -1,28 +1,26 @@
-import json
-import math
+import itertools
 import random
 from datetime import datetime, timedelta
 from typing import Any, Iterable
 
-import psycopg2
 import scrapy
 from scrapy import Request
 from scrapy.http import Response
-from scrapy.loader import ItemLoader
 from scrapy.spidermiddlewares.httperror import HttpError
 
 from kaimono.items import CategoryItem, ProductItem, ProductCategoryItem, TagItem, \
     ProductInventoryItem, ProductInventoryTagItem, ProductImageItem, ProductToRemoveItem
-from kaimono.settings import DATABASE_SETTINGS
-from kaimono.utils import build_rakuten_id, category_ids_for_scrape, get_genres_tree, get_site_id_from_db_id, \
-    tag_exists, get_product_variation_id, product_ids_to_check_count, product_ids_to_check, \
-    delete_product_exclude_images
+from kaimono.spiders import PSQLPoolMixin
+from kaimono.utils import build_rakuten_id, build_rakuten_ids, category_ids_for_scrape, get_genres_tree, \
+    get_site_id_from_db_id, tags_exist, get_product_variation_ids, product_ids_to_check_count, product_ids_to_check, \
+    delete_products_exclude_images, json_loads
 
 RAKUTEN_BASE_URL = "https://app.rakuten.co.jp/"
 
 
-def random_rakuten_app_id(app_ids):
-    return random.choice(app_ids)
+def rakuten_app_ids_cycle(app_ids):
+    # round-robin over shuffled ids spreads requests evenly, each app id has its own rate limit
+    return itertools.cycle(random.sample(app_ids, len(app_ids)))
 
 
 class RakutenCategorySpider(scrapy.Spider):
@@ -39,43 +37,37 @@ class RakutenCategorySpider(scrapy.Spider):
         "CONCURRENT_REQUESTS": len(RAKUTEN_APP_IDS) * 2
     }
     API_URL = RAKUTEN_BASE_URL + ("services/api/IchibaGenre/Search/20120723"
-                                  "?applicationId={app_id}&formatVersion=2&genreId={genre_id}")
-    start_urls = [API_URL.format(app_id=random_rakuten_app_id(RAKUTEN_APP_IDS), genre_id="0")]
+                                  "?applicationId=%s&formatVersion=2&genreId=%s")
+    app_ids = rakuten_app_ids_cycle(RAKUTEN_APP_IDS)
+    start_urls = [API_URL % (next(app_ids), "0")]
 
     def parse(self, response: Response, **kwargs: Any) -> Any:
-        response_data = json.loads(response.body)
+        response_data = json_loads(response.body)
         current_data = response_data['current']
         children_data = response_data.get('children')
         parents_data = response_data.get('parents')
 
         current_id = build_rakuten_id(current_data['genreId'])
-        current_loader = ItemLoader(CategoryItem())
-
-        current_loader.add_value("id", current_id)
-        current_loader.add_value("name", current_data['genreName'])
+        current_item = CategoryItem(id=current_id, name=current_data['genreName'], level=current_data['genreLevel'])
         if parents_data:
-            current_loader.add_value("parent_id", build_rakuten_id(parents_data[-1]["genreId"]))
-        current_loader.add_value("level", current_data['genreLevel'])
-        yield current_loader.load_item()
+            current_item["parent_id"] = build_rakuten_id(parents_data[-1]["genreId"])
+        yield current_item
 
-        children_genres_loader = ItemLoader(CategoryItem())
         for child in children_data or []:
             child_id = child['genreId']
-            children_genres_loader.add_value("id", build_rakuten_id(child_id))
-            children_genres_loader.add_value("name", child['genreName'])
-            children_genres_loader.add_value("parent_id", current_id)
-            children_genres_loader.add_value("level", child['genreLevel'])
+            yield CategoryItem(
+                id=build_rakuten_id(child_id),
+                name=child['genreName'],
+                parent_id=current_id,
+                level=child['genreLevel']
+            )
             yield scrapy.Request(
-                url=self.API_URL.format(
-                    app_id=random_rakuten_app_id(self.RAKUTEN_APP_IDS),
-                    genre_id=child_id
-                ),
+                url=self.API_URL % (next(self.app_ids), child_id),
                 callback=self.parse
             )
-        yield children_genres_loader.load_item()
 
 
-class RakutenSpider(scrapy.Spider):
+class RakutenSpider(PSQLPoolMixin, scrapy.Spider):
     name = "rakuten"
     RAKUTEN_APP_IDS = (
         "1006081949539677212",
@@ -93,173 +85,181 @@ class RakutenSpider(scrapy.Spider):
         "CONCURRENT_REQUESTS": len(RAKUTEN_APP_IDS) * 2,
         "DOWNLOAD_DELAY": 0.2
     }
+    app_ids = rakuten_app_ids_cycle(RAKUTEN_APP_IDS)
 
     API_URL = ("https://app.rakuten.co.jp/services/api/IchibaItem/Search/20220601"
-               "?applicationId={app_id}&formatVersion=2&genreId={genre_id}"
-               "&genreInformationFlag=0&tagInformationFlag=1&availability=1&page={page}")
+               "?applicationId=%s&formatVersion=2&genreId=%s"
+               "&genreInformationFlag=0&tagInformationFlag=1&availability=1&page=%d")
 
     TAG_API_URL = RAKUTEN_BASE_URL + ("services/api/IchibaTag/Search/20140222?"
-                                      "applicationId={app_id}&formatVersion=2&tagId={tag_id}")
+                                      "applicationId=%s&formatVersion=2&tagId=%s")
     MAX_PAGES = 1
 
     def __init__(self, *args, **kwargs):
-        assert self.RAKUTEN_APP_IDS
+        if not self.RAKUTEN_APP_IDS:
+            raise ValueError(f"{self.__class__.__name__}.RAKUTEN_APP_IDS must not be empty")
         super().__init__(*args, **kwargs)
-        self.psql_con = psycopg2.connect(**DATABASE_SETTINGS)
-        self.category_ids = category_ids_for_scrape(self.psql_con, self.name)
+        # category trees don't change during a crawl, but are needed for every page
+        self.genres_trees: dict[str, tuple[str]] = {}
+        # tags only get added during a crawl, so once known to exist they aren't checked again
+        self.known_tag_ids = set()
 
     def start_requests(self) -> Iterable[Request]:
-        for category_id in self.category_ids:
+        for category_id in self.pooled_query(category_ids_for_scrape, self.name):
             site_category_id = get_site_id_from_db_id(category_id)
             yield scrapy.Request(
-                url=self.API_URL.format(
-                    app_id=random_rakuten_app_id(self.RAKUTEN_APP_IDS),
-                    genre_id=site_category_id,
-                    page=1
-                ),
+                url=self.API_URL % (next(self.app_ids), site_category_id, 1),
                 callback=self.parse,
-                meta={"category_id": category_id, "site_category_id": site_category_id, "page_num": 1}
+                cb_kwargs={"category_id": category_id, "site_category_id": site_category_id, "page_num": 1}
             )
 
-    def parse(self, response: Response, **kwargs: Any) -> Any:
-        response_data = json.loads(response.body)
+    async def parse(
+        self,
+        response: Response,
+        category_id: str,
+        site_category_id: str,
+        page_num: int,
+        **kwargs: Any
+    ) -> Any:
+        response_data = json_loads(response.body)
 
         tags_info = response_data['TagInformation']
         has_tags_info = bool(tags_info)
         if has_tags_info:
-            yield from self.parse_tags(tags_info)
-
-        category_id = response.meta['category_id']
-        categories_tree = get_genres_tree(self.psql_con, category_id)
-
-        item_loader = ItemLoader(ProductItem())
-        item_category_loader = ItemLoader(ProductCategoryItem())
-        item_image_loader = ItemLoader(ProductImageItem())
-        item_inventory_loader = ItemLoader(ProductInventoryItem())
-        inventory_tag_loader = ItemLoader(ProductInventoryTagItem())
+            for tag_item in self.parse_tags(tags_info):
+                yield tag_item
+
+        categories_tree = self.genres_trees.get(category_id)
+        if categories_tree is None:
+            categories_tree = await self.run_query(get_genres_tree, category_id)
+            categories_tree = self.genres_trees[category_id] = tuple(categories_tree)
+
+        items_data = response_data['Items']
+        unknown_tag_ids = {
+            db_tag_id for item in items_data for db_tag_id in build_rakuten_ids(item["tagIds"])
+        } - self.known_tag_ids
+        if unknown_tag_ids:
+            self.known_tag_ids.update(await self.run_query(tags_exist, unknown_tag_ids))
+        # {(category_id, catch_copy, shop_code): product_id, ...} saved before and created on this page
+        catch_copies = await self.run_query(
+            get_product_variation_ids,
+            {(category_id, item["catchcopy"], item["shopCode"]) for item in items_data}
+        )
 
         processed_ids = set()
-        catch_copies = {}
+        seen_image_pairs = set()
         request_to_tags = []
+        images_to_keep, image_items = {}, []
 
-        for item in response_data['Items']:
+        for item in items_data:
             item_code = item["itemCode"]
             item_id = build_rakuten_id(item_code)
             if item_id in processed_ids:
                 continue
 
             catch_copy, shop_code = item["catchcopy"], item["shopCode"]
-            variation_id = (
-                catch_copies.get(shop_code + catch_copy) or
-                get_product_variation_id(self.psql_con, category_id, catch_copy, shop_code)
-            )
+            variation_id = catch_copies.get((category_id, catch_copy, shop_code))
 
             if not variation_id:
-                item_loader.add_value("id", item_id)
-                item_loader.add_value("name", item["itemName"])
-                item_loader.add_value("description", item["itemCaption"])
-                item_loader.add_value("site_avg_rating", item["reviewAverage"])
-                item_loader.add_value("site_reviews_count", item["reviewCount"])
-                item_loader.add_value("shop_code", shop_code)
-                item_loader.add_value("catch_copy", catch_copy)
-                item_loader.add_value("shop_url", item["shopUrl"])
-                item_loader.add_value("can_choose_tags", False)
-                catch_copies[shop_code + catch_copy] = item_id
-
-                for category_id in categories_tree:
-                    item_category_loader.add_value("product_id", item_id)
-                    item_category_loader.add_value("category_id", category_id)
-
-                image_urls = list(map(lambda img: img.split("?")[0], item["mediumImageUrls"] or item["smallImageUrls"]))
-                delete_product_exclude_images(self.psql_con, product_id=item_id, image_urls=image_urls)
+                yield ProductItem(
+                    id=item_id,
+                    name=item["itemName"],
+                    description=item["itemCaption"],
+                    site_avg_rating=item["reviewAverage"],
+                    site_reviews_count=item["reviewCount"],
+                    shop_code=shop_code,
+                    catch_copy=catch_copy,
+                    shop_url=item["shopUrl"],
+                    can_choose_tags=False
+                )
+                catch_copies[(category_id, catch_copy, shop_code)] = item_id
+
+                for tree_category_id in categories_tree:
+                    yield ProductCategoryItem(product_id=item_id, category_id=tree_category_id)
+
+                image_urls = [img.partition("?")[0] for img in item["mediumImageUrls"] or item["smallImageUrls"]]
+                images_to_keep[item_id] = image_urls
 
                 for img_link in image_urls:
-                    item_image_loader.add_value("product_id", item_id)
-                    item_image_loader.add_value("url", img_link)
+                    # the same image comes with different query params, which are cut off above
+                    if (item_id, img_link) in seen_image_pairs:
+                        continue
 
-                variation_id = item_id
+                    seen_image_pairs.add((item_id, img_link))
+                    image_items.append(ProductImageItem(product_id=item_id, url=img_link))
 
-            item_inventory_loader.add_value("id", item_id)
-            item_inventory_loader.add_value("product_id", variation_id)
-            item_inventory_loader.add_value("item_code", item_code)
-            item_inventory_loader.add_value("site_price", item['itemPrice'])
-            item_inventory_loader.add_value("product_url", item["itemUrl"])
-            item_inventory_loader.add_value("name", item["itemName"]),
+                variation_id = item_id
 
-            for tag_id in item["tagIds"]:
-                db_tag_id = build_rakuten_id(tag_id)
+            yield ProductInventoryItem(
+                id=item_id,
+                product_id=variation_id,
+                item_code=item_code,
+                site_price=item['itemPrice'],
+                product_url=item["itemUrl"],
+                name=item["itemName"]
+            )
 
-                if not tag_exists(self.psql_con, db_tag_id):
+            tag_ids = item["tagIds"]
+            for tag_id, db_tag_id in zip(tag_ids, build_rakuten_ids(tag_ids)):
+                if db_tag_id not in self.known_tag_ids:
                     request_to_tags.append((item_id, tag_id, db_tag_id))
                     continue
 
-                inventory_tag_loader.add_value("productinventory_id", item_id)
-                inventory_tag_loader.add_value("tag_id", db_tag_id)
+                yield ProductInventoryTagItem(productinventory_id=item_id, tag_id=db_tag_id)
 
             processed_ids.add(item_id)
 
-        yield item_loader.load_item()
-        yield item_category_loader.load_item()
-        yield item_image_loader.load_item()
-        yield item_inventory_loader.load_item()
+        if images_to_keep:
+            # outdated images of the whole page are removed at once before the actual ones are saved
+            await self.run_query(delete_products_exclude_images, images_to_keep)
+
+            for image_item in image_items:
+                yield image_item
 
         for item_id, tag_id, db_tag_id in request_to_tags:
             yield scrapy.Request(
-                url=self.TAG_API_URL.format(
-                    app_id=random_rakuten_app_id(self.RAKUTEN_APP_IDS),
-                    tag_id=tag_id
-                ),
+                url=self.TAG_API_URL % (next(self.app_ids), tag_id),
                 callback=self.parse_tag,
-                meta={"item_id": item_id, 'db_tag_id': db_tag_id}
+                cb_kwargs={"item_id": item_id, "db_tag_id": db_tag_id}
             )
 
-        yield inventory_tag_loader.load_item()
-
-        page_num = response.meta['page_num'] + 1
-        pages_count = response_data['pageCount']
+        if page_num > 1:
+            return
 
-        if self.MAX_PAGES >= page_num < pages_count:
-            response.meta['page_num'] = page_num
+        # pages count is known from the first page, so the rest are requested at once
+        last_page_num = min(self.MAX_PAGES, response_data['pageCount'])
+        for next_page_num in range(2, last_page_num + 1):
             yield scrapy.Request(
-                url=self.API_URL.format(
-                    app_id=random_rakuten_app_id(self.RAKUTEN_APP_IDS),
-                    genre_id=response.meta['site_category_id'],
-                    page=page_num
-                ),
+                url=self.API_URL % (next(self.app_ids), site_category_id, next_page_num),
                 callback=self.parse,
-                meta=response.meta
+                cb_kwargs={
+                    "category_id": category_id,
+                    "site_category_id": site_category_id,
+                    "page_num": next_page_num
+                }
             )
 
-    def parse_tag(self, response: Response):
-        response_data = json.loads(response.body)
+    def parse_tag(self, response: Response, item_id: str, db_tag_id: str):
+        response_data = json_loads(response.body)
         yield from self.parse_tags(response_data['tagGroups'])
 
-        loader = ItemLoader(ProductInventoryTagItem())
-        loader.add_value("productinventory_id", response.meta['item_id'])
-        loader.add_value("tag_id", response.meta['db_tag_id'])
-        yield loader.load_item()
+        yield ProductInventoryTagItem(
+            productinventory_id=item_id,
+            tag_id=db_tag_id
+        )
 
     def parse_tags(self, tags_data):
-        tag_group_loader = ItemLoader(TagItem())
-        tag_loader = ItemLoader(TagItem())
-
         for tag_group_data in tags_data:
             group_id = build_rakuten_id(tag_group_data["tagGroupId"])
-            tag_group_loader.add_value("id", group_id)
-            group_name = tag_group_data["tagGroupName"]
-            tag_group_loader.add_value("name", group_name)
+            yield TagItem(id=group_id, name=tag_group_data["tagGroupName"])
 
             for tag_data in tag_group_data["tags"]:
                 tag_id = build_rakuten_id(tag_data["tagId"])
-                tag_loader.add_value("id", tag_id)
-                tag_loader.add_value("name", tag_data["tagName"])
-                tag_loader.add_value("group_id", group_id)
-
-        yield tag_group_loader.load_item()
-        yield tag_loader.load_item()
+                self.known_tag_ids.add(tag_id)
+                yield TagItem(id=tag_id, name=tag_data["tagName"], group_id=group_id)
 
 
-class RakutenProductSpider(scrapy.Spider):
+class RakutenProductSpider(PSQLPoolMixin, scrapy.Spider):
     name = "rakuten_products"
 
     RAKUTEN_APP_IDS = (
@@ -280,56 +280,51 @@ class RakutenProductSpider(scrapy.Spider):
             "kaimono.pipelines.PSQLRemovePipeline": 300,
         },
     }
+    app_ids = rakuten_app_ids_cycle(RAKUTEN_APP_IDS)
 
     API_URL = ("https://app.rakuten.co.jp/services/api/IchibaItem/Search/20220601"
-               "?applicationId={app_id}&formatVersion=2&itemCode={item_code}"
+               "?applicationId=%s&formatVersion=2&itemCode=%s"
                "&genreInformationFlag=0&tagInformationFlag=0&availability=1")
     CHECK_PAGE_LIMIT = 100
 
     def __init__(self, *args, **kwargs):
-        assert self.RAKUTEN_APP_IDS
+        if not self.RAKUTEN_APP_IDS:
+            raise ValueError(f"{self.__class__.__name__}.RAKUTEN_APP_IDS must not be empty")
         super().__init__(*args, **kwargs)
-        self.psql_con = psycopg2.connect(**DATABASE_SETTINGS)
         self.month_ago = datetime.utcnow() - timedelta(days=31)
-        self.products_count = product_ids_to_check_count(
-            conn=self.psql_con,
-            site="rakuten",
-            check_time=self.month_ago
-        )
-        self.pages = math.ceil(self.products_count / self.CHECK_PAGE_LIMIT)
 
     def start_requests(self) -> Iterable[Request]:
-        if self.products_count <= 0:
+        products_count = self.pooled_query(product_ids_to_check_count, site="rakuten", check_time=self.month_ago)
+        if products_count <= 0:
             return
 
-        offset = 0
-        for _ in range(self.pages):
-            for product_id in product_ids_to_check(
-                self.psql_con,
+        # products are deleted while the crawl goes on, so pages start after the last seen id instead of an offset
+        after_id = ""
+        while True:
+            product_ids = self.pooled_query(
+                product_ids_to_check,
                 site="rakuten",
                 check_time=self.month_ago,
                 limit=self.CHECK_PAGE_LIMIT,
-                offset=offset
-            ):
-                product_id = product_id[0]
-                item_code = product_id.split("_")[-1]
+                after_id=after_id
+            )
+            if not product_ids:
+                break
+
+            for product_id in product_ids:
+                item_code = get_site_id_from_db_id(product_id)
 
                 yield scrapy.Request(
-                    url=self.API_URL.format(
-                        app_id=random_rakuten_app_id(self.RAKUTEN_APP_IDS),
-                        item_code=item_code
-                    ),
+                    url=self.API_URL % (next(self.app_ids), item_code),
                     callback=self.parse,
                     meta={"product_id": product_id, "item_code": item_code},
                 )
 
-            offset += self.CHECK_PAGE_LIMIT
+            after_id = product_ids[-1]
 
     def parse(self, response: Response, **kwargs: Any) -> Any:
-        response_data = json.loads(response.body)
+        response_data = json_loads(response.body)
 
         if not response_data.get("items"):
-            product_remove_loader = ItemLoader(ProductToRemoveItem())
-            product_remove_loader.add_value("id", response.meta["product_id"])
-            yield product_remove_loader.load_item()
+            yield ProductToRemoveItem(id=response.meta["product_id"])
 
@@ -1,14 +1,12 @@
-import json
 import math
 import re
 import unicodedata
+from functools import lru_cache
+from operator import itemgetter
 from typing import Iterable, Any
 
-import psycopg2
 import scrapy
-from itemloaders import ItemLoader
 from scrapy import Request
-from scrapy.loader import ItemLoader
 from scrapy.http import Response
 
 from kaimono.items import (
@@ -16,10 +14,10 @@ from kaimono.items import (
     ProductItem, ProductCategoryItem,
     ProductInventoryTagItem, ProductInventoryItem, ProductImageItem
 )
-from kaimono.settings import DATABASE_SETTINGS
+from kaimono.spiders import PSQLPoolMixin
 from kaimono.utils import (
     build_uniqlo_id, category_ids_for_scrape, get_site_id_from_db_id,
-    delete_product_exclude_images
+    delete_products_exclude_images, json_loads
 )
 
 
@@ -36,7 +34,7 @@ class UniqloCategorySpider(scrapy.Spider):
         yield Request(self.API_URL, callback=self.parse)
 
     def parse(self, response: Response, **kwargs: Any) -> Any:
-        response_data = json.loads(response.body)
+        response_data = json_loads(response.body)
         result = response_data['result']
         yield from self.load_categories(result['genders'], 1)
         yield from self.load_categories(result['classes'], 2)
@@ -44,18 +42,24 @@ class UniqloCategorySpider(scrapy.Spider):
 
     @staticmethod
     def load_categories(categories, level: int):
-        loader = ItemLoader(CategoryItem())
         for category in categories:
-            loader.add_value('id', build_uniqlo_id(category['id']))
-            loader.add_value('name', category['name'])
-            loader.add_value('level', level)
+            parents = category.get('parents')
+            yield CategoryItem(
+                id=build_uniqlo_id(category['id']),
+                name=category['name'],
+                level=level,
+                parent_id=build_uniqlo_id(parents[-1]['id']) if parents else None
+            )
+
+
+get_code_and_name = itemgetter('displayCode', 'name')
 
-            parent_site_ids = [parent['id'] for parent in category.get('parents') or []]
-            if parent_site_ids:
-                loader.add_value('parent_id', build_uniqlo_id(parent_site_ids[-1]))
-        yield loader.load_item()
+SLUG_STRIP_RE = re.compile(r"[^\w\s-]")
+SLUG_DASH_RE = re.compile(r"[-\s]+")
 
 
+# colors and sizes repeat over the products, so their slugs are cached
+@lru_cache(maxsize=4096)
 def slugify(value, allow_unicode=False):
     value = str(value)
     if allow_unicode:
@@ -66,43 +70,73 @@ def slugify(value, allow_unicode=False):
             .encode("ascii", "ignore")
             .decode("ascii")
         )
-    value = re.sub(r"[^\w\s-]", "", value.lower())
-    return re.sub(r"[-\s]+", "-", value).strip("-_")
+    value = SLUG_STRIP_RE.sub("", value.lower())
+    return SLUG_DASH_RE.sub("-", value).strip("-_")
 
 
-class UniqloSpider(scrapy.Spider):
+def build_tag_info(name: str) -> tuple[str, str, str]:
+    slug = slugify(name)
+    return name, slug, build_uniqlo_id(slug)
+
+
+class UniqloSpider(PSQLPoolMixin, scrapy.Spider):
     name = "uniqlo"
     custom_settings = {
         'LOG_LEVEL': 'INFO',
         'RETRY_ENABLED': True,
-        'COOKIES_ENABLED': False
+        'COOKIES_ENABLED': False,
+        # every request goes to the same host, so they are multiplexed over one HTTP/2 connection
+        'DOWNLOAD_HANDLERS': {'https': 'scrapy.core.downloader.handlers.http2.H2DownloadHandler'},
+        'CONCURRENT_REQUESTS': 32,
+        'CONCURRENT_REQUESTS_PER_DOMAIN': 32,
+        'AUTOTHROTTLE_ENABLED': True,
+        'AUTOTHROTTLE_TARGET_CONCURRENCY': 16.0
     }
     PAGE_LIMIT = 36
     BASE_API_URL = "https://www.uniqlo.com/us/api/commerce/v5/en/products"
-    LIST_API_URL = BASE_API_URL + ("?categoryId={genre_id}"
-                                   "&offset={offset}&limit={limit}&httpFailure=true")
-    DETAIL_API_URL = BASE_API_URL + ("/{product_id}/price-groups/{price_group}/details"
-                                     "?includeModelSize=true&httpFailure=true"
-                                     "&withPrices=true&withStocks=true")
-    PRICES_API_URL = BASE_API_URL + ("/{product_id}/price-groups/{price_group}/l2s"
-                                     "?withPrices=true&withStocks=true&includePreviousPrice=false&httpFailure=true")
-
-    ITEM_URL = "https://www.uniqlo.com/us/en/products/{item_code}/"
+    ITEM_URL = "https://www.uniqlo.com/us/en/products/"
+    DELETE_IMAGES_BATCH_SIZE = 100
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
-        self.psql_conn = psycopg2.connect(**DATABASE_SETTINGS)
-        self.category_ids = category_ids_for_scrape(self.psql_conn, "uniqlo")
+        # {product_id: [image_url, ...], ...} whose other images are deleted in batches
+        self.images_to_keep = {}
+
+    def closed(self, reason):
+        try:
+            if self.images_to_keep:
+                self.pooled_query(delete_products_exclude_images, self.images_to_keep)
+        except Exception as e:
+            self.logger.error(f"Failed to delete outdated images of {len(self.images_to_keep)} products: {e}")
+        finally:
+            super().closed(reason)
+
+    async def delete_outdated_images(self):
+        # the batch is taken before awaiting, so products parsed meanwhile go into the next one
+        images_to_keep, self.images_to_keep = self.images_to_keep, {}
+        try:
+            await self.run_query(delete_products_exclude_images, images_to_keep)
+        except Exception as e:
+            # the batch is retried with the next one, products parsed meanwhile keep their newer urls
+            self.images_to_keep = images_to_keep | self.images_to_keep
+            self.logger.error(f"Failed to delete outdated images of {len(images_to_keep)} products: {e}")
+
+    def list_url(self, genre_id: str, offset: int) -> str:
+        return f"{self.BASE_API_URL}?categoryId={genre_id}&offset={offset}&limit={self.PAGE_LIMIT}&httpFailure=true"
+
+    def detail_url(self, product_id: str, price_group: str) -> str:
+        return (f"{self.BASE_API_URL}/{product_id}/price-groups/{price_group}/details"
+                "?includeModelSize=true&httpFailure=true&withPrices=true&withStocks=true")
+
+    def prices_url(self, product_id: str, price_group: str) -> str:
+        return (f"{self.BASE_API_URL}/{product_id}/price-groups/{price_group}/l2s"
+                "?withPrices=true&withStocks=true&includePreviousPrice=false&httpFailure=true")
 
     def start_requests(self) -> Iterable[Request]:
-        for category_id in self.category_ids:
+        for category_id in self.pooled_query(category_ids_for_scrape, "uniqlo"):
             site_category_id = get_site_id_from_db_id(category_id)
             yield scrapy.Request(
-                url=self.LIST_API_URL.format(
-                    genre_id=site_category_id,
-                    offset=0,
-                    limit=self.PAGE_LIMIT
-                ),
+                url=self.list_url(site_category_id, offset=0),
                 callback=self.parse,
                 meta={"category_id": category_id}
             )
@@ -112,119 +146,132 @@ class UniqloSpider(scrapy.Spider):
         yield from self.parse_pages(response)
 
     def parse_items(self, response: Response):
-        response_data = json.loads(response.body)['result']
+        response_data = json_loads(response.body)['result']
         for item in response_data['items']:
             item_code = item['productId']
             price_group = item['priceGroup']
             yield scrapy.Request(
-                url=self.DETAIL_API_URL.format(product_id=item_code, price_group=price_group),
+                url=self.detail_url(item_code, price_group),
                 callback=self.parse_product_items,
-                meta={"item_code": item_code, "price_group": price_group} | response.meta
+                meta={"item_code": item_code, "price_group": price_group}
             )
 
-    def parse_product_items(self, response: Response):
-        response_data = json.loads(response.body)['result']
+    async def parse_product_items(self, response: Response):
+        response_data = json_loads(response.body)['result']
         item_code = response.meta['item_code']
         product_id = build_uniqlo_id(item_code)
 
-        loader = ItemLoader(ProductItem())
-        loader.add_value("id", product_id)
-        loader.add_value("name", response_data['name'])
-        loader.add_value("description", response_data['longDescription'])
-        loader.add_value("site_avg_rating", response_data['rating'].get('average', 0.0))
-        loader.add_value("site_reviews_count", response_data['rating'].get('count', 0))
-        loader.add_value("shop_url", "https://www.uniqlo.com")
-        loader.add_value("shop_code", "uniqlo")
-        loader.add_value("can_choose_tags", True)
-        yield loader.load_item()
-
-        item_image_loader = ItemLoader(ProductImageItem())
+        yield ProductItem(
+            id=product_id,
+            name=response_data['name'],
+            description=response_data['longDescription'],
+            site_avg_rating=response_data['rating'].get('average', 0.0),
+            site_reviews_count=response_data['rating'].get('count', 0),
+            shop_url="https://www.uniqlo.com",
+            shop_code="uniqlo",
+            can_choose_tags=True
+        )
+
         images_data = response_data['images']
 
         image_urls = [image_data["image"] for image_data in images_data['main'].values() if image_data.get("image")]
         if not image_urls:
             image_urls = [image_data["image"] for image_data in images_data['sub'] if image_data.get("image")]
 
-        delete_product_exclude_images(self.psql_conn, product_id=product_id, image_urls=image_urls)
+        self.images_to_keep[product_id] = image_urls
+        if len(self.images_to_keep) >= self.DELETE_IMAGES_BATCH_SIZE:
+            await self.delete_outdated_images()
 
         for img_link in image_urls:
-            item_image_loader.add_value("product_id", product_id)
-            item_image_loader.add_value("url", img_link)
-
-        yield item_image_loader.load_item()
+            yield ProductImageItem(product_id=product_id, url=img_link)
 
         breadcrumbs = response_data['breadcrumbs']
         # sometimes categories in key "subcategory" come
         #   that were not saved into uniqlo_category
         subcategory_data = breadcrumbs.get('subcategory')
         if subcategory_data:
-            subgenre_loader = ItemLoader(CategoryItem())
-            subgenre_loader.add_value('id', build_uniqlo_id(subcategory_data['id']))
-            subgenre_loader.add_value('name', subcategory_data['locale'])
-            subgenre_loader.add_value('parent_id', build_uniqlo_id(breadcrumbs['category']['id']))
-            subgenre_loader.add_value('level', subcategory_data['level'])
-            yield subgenre_loader.load_item()
-
-        product_category_loader = ItemLoader(ProductCategoryItem())
-        for genre_data in breadcrumbs.values():
-            product_category_loader.add_value("product_id", product_id)
-            product_category_loader.add_value("category_id", build_uniqlo_id(genre_data['id']))
-        yield product_category_loader.load_item()
-
-        group_loader = ItemLoader(TagItem())
-        tags_loader = ItemLoader(TagItem())
+            yield CategoryItem(
+                id=build_uniqlo_id(subcategory_data['id']),
+                name=subcategory_data['locale'],
+                parent_id=build_uniqlo_id(breadcrumbs['category']['id']),
+                level=subcategory_data['level']
+            )
 
+        # the same category can come under several breadcrumb levels
+        for category_id in {build_uniqlo_id(genre_data['id']) for genre_data in breadcrumbs.values()}:
+            yield ProductCategoryItem(product_id=product_id, category_id=category_id)
+
+        seen_groups = set()
         for tag in response_data.get('tags') or []:
             group_id = build_uniqlo_id(tag['group'])
-            group_loader.add_value("id", group_id)
-            group_loader.add_value("name", tag["groupName"])
-
-            tag_id = build_uniqlo_id(f"{tag['group']}:{tag['tag']}")
-            tags_loader.add_value("id", tag_id)
-            tags_loader.add_value("name", tag["tagName"])
-            tags_loader.add_value("group_id", group_id)
-
-        yield group_loader.load_item()
-        yield tags_loader.load_item()
-
-        response.meta['colors'] = response_data['colors']
-        response.meta['item_images'] = response_data['images']
-        response.meta['color_images'] = response_data['images']['chip']
-        response.meta['sizes'] = response_data['sizes']
-        response.meta['db_product_id'] = product_id
+            if group_id not in seen_groups:
+                seen_groups.add(group_id)
+                yield TagItem(id=group_id, name=tag["groupName"])
+
+            yield TagItem(
+                id=build_uniqlo_id(f"{tag['group']}:{tag['tag']}"),
+                name=tag["tagName"],
+                group_id=group_id
+            )
+
+        if all(key in response_data for key in ('l2s', 'stocks', 'prices')):
+            # details already come with prices and stocks, so the l2s endpoint isn't requested
+            for item in self.load_inventories(
+                prices_data=response_data,
+                product_id=product_id,
+                item_code=item_code,
+                colors_data=response_data['colors'],
+                color_images=images_data['chip'],
+                sizes_data=response_data['sizes']
+            ):
+                yield item
+            return
+
         yield scrapy.Request(
-            url=self.PRICES_API_URL.format(
-                product_id=item_code,
-                price_group=response.meta['price_group']
-            ),
+            url=self.prices_url(item_code, response.meta['price_group']),
             callback=self.parse_item_prices,
-            meta=response.meta
+            # only what parse_item_prices reads, so the whole details payload isn't kept with the request
+            meta={
+                "db_product_id": product_id,
+                "item_code": item_code,
+                "colors": response_data['colors'],
+                "color_images": images_data['chip'],
+                "sizes": response_data['sizes']
+            }
         )
 
     def parse_item_prices(self, response: Response):
-        product_id = response.meta['db_product_id']
-        item_code = response.meta['item_code']
-
-        color_images = response.meta['color_images']
-        colors = {color['displayCode']: color['name'] for color in response.meta['colors']}
-        sizes = {size['displayCode']: size['name'] for size in response.meta['sizes']}
-
-        response_data = json.loads(response.body)['result']
-        combines = response_data['l2s']
-        stocks = response_data['stocks']
-        prices = response_data['prices']
-
-        group_loader = ItemLoader(TagItem())
-        group_loader.add_value("id", "uniqlo_s1izes")
-        group_loader.add_value("name", "Sizes")
-        group_loader.add_value("id", "uniqlo_c1olors")
-        group_loader.add_value("name", "Colors")
-        yield group_loader.load_item()
+        yield from self.load_inventories(
+            prices_data=json_loads(response.body)['result'],
+            product_id=response.meta['db_product_id'],
+            item_code=response.meta['item_code'],
+            colors_data=response.meta['colors'],
+            color_images=response.meta['color_images'],
+            sizes_data=response.meta['sizes']
+        )
 
-        tag_loader = ItemLoader(TagItem())
-        inventory_loader = ItemLoader(ProductInventoryItem())
-        inventory_tag_loader = ItemLoader(ProductInventoryTagItem())
-        processed_ids = set()
+    def load_inventories(
+        self,
+        prices_data: dict,
+        product_id: str,
+        item_code: str,
+        colors_data: list[dict],
+        color_images: dict[str, str],
+        sizes_data: list[dict]
+    ):
+        # {display_code: (name, slug, tag_id), ...} built once instead of for every combination
+        colors = {code: build_tag_info(name) for code, name in map(get_code_and_name, colors_data)}
+        sizes = {code: build_tag_info(name) for code, name in map(get_code_and_name, sizes_data)}
+
+        combines = prices_data['l2s']
+        stocks = prices_data['stocks']
+        prices = prices_data['prices']
+
+        yield TagItem(id="uniqlo_s1izes", name="Sizes")
+        yield TagItem(id="uniqlo_c1olors", name="Colors")
+
+        product_url = f"{self.ITEM_URL}{item_code}/"
+        seen_tags: set[str] = set()
 
         for data in combines:
             combine_id = data['l2Id']
@@ -232,65 +279,44 @@ class UniqloSpider(scrapy.Spider):
             stock_data = stocks[combine_id]
             price_data = prices[combine_id]
 
-            color_name, size_name = colors[color_code], sizes[data['size']['displayCode']]
-            color_slug, size_slug = slugify(color_name), slugify(size_name)
-            color_tag_id, size_tag_id = build_uniqlo_id(color_slug), build_uniqlo_id(size_slug)
+            color_name, color_slug, color_tag_id = colors[color_code]
+            size_name, size_slug, size_tag_id = sizes[data['size']['displayCode']]
 
-            if color_tag_id not in processed_ids:
-                tag_loader.add_value("id", color_tag_id)
-                tag_loader.add_value("name", color_name)
-                tag_loader.add_value("group_id", "uniqlo_c1olors")
-                processed_ids.add(color_tag_id)
+            if color_tag_id not in seen_tags:
+                seen_tags.add(color_tag_id)
+                yield TagItem(id=color_tag_id, name=color_name, group_id="uniqlo_c1olors")
 
-            if size_tag_id not in processed_ids:
-                tag_loader.add_value("id", size_tag_id)
-                tag_loader.add_value("name", size_name)
-                tag_loader.add_value("group_id", "uniqlo_s1izes")
-                processed_ids.add(size_tag_id)
+            if size_tag_id not in seen_tags:
+                seen_tags.add(size_tag_id)
+                yield TagItem(id=size_tag_id, name=size_name, group_id="uniqlo_s1izes")
 
             inventory_id = f"{product_id}-{color_slug}-{size_slug}"
-            inventory_loader.add_value("id", inventory_id)
-            inventory_loader.add_value("product_id", product_id)
-            inventory_loader.add_value("item_code", product_id)
-            inventory_loader.add_value("site_price", price_data['base']['value'])
-            inventory_loader.add_value("product_url", self.ITEM_URL.format(item_code=item_code))
-            inventory_loader.add_value("name", f"Color: {color_name} Size: {size_name}")
-            inventory_loader.add_value("quantity", stock_data['quantity'])
-            inventory_loader.add_value("status_code", stock_data['statusLocalized'])
-            color_image = color_images.get(color_code)
-            if color_image:
-                inventory_loader.add_value("color_image", color_image)
-            else:
-                inventory_loader.add_value("color_image", "")
-
-            if (color_tag_id, size_tag_id, inventory_id) not in processed_ids:
-                inventory_tag_loader.add_value("productinventory_id", inventory_id)
-                inventory_tag_loader.add_value("tag_id", size_tag_id)
-                inventory_tag_loader.add_value("productinventory_id", inventory_id)
-                inventory_tag_loader.add_value("tag_id", color_tag_id)
-                processed_ids.add((color_tag_id, size_tag_id, inventory_id))
-
-        yield inventory_loader.load_item()
-        yield tag_loader.load_item()
-        yield inventory_tag_loader.load_item()
+            yield ProductInventoryItem(
+                id=inventory_id,
+                product_id=product_id,
+                item_code=product_id,
+                site_price=price_data['base']['value'],
+                product_url=product_url,
+                name=f"Color: {color_name} Size: {size_name}",
+                quantity=stock_data['quantity'],
+                status_code=stock_data['statusLocalized'],
+                color_image=color_images.get(color_code) or ""
+            )
+            yield ProductInventoryTagItem(productinventory_id=inventory_id, tag_id=size_tag_id)
+            yield ProductInventoryTagItem(productinventory_id=inventory_id, tag_id=color_tag_id)
 
     def parse_pages(self, response: Response):
-        pagination_data = json.loads(response.body)['result']['pagination']
+        pagination_data = json_loads(response.body)['result']['pagination']
         total = pagination_data['total']
 
         if total > self.PAGE_LIMIT:
             pages_count = math.ceil(total / self.PAGE_LIMIT)
             category_id = get_site_id_from_db_id(response.meta['category_id'])
-            for page in range(2, pages_count + 1):
-                url = self.LIST_API_URL.format(
-                    genre_id=category_id,
-                    offset=pagination_data['offset'] + self.PAGE_LIMIT,
-                    limit=self.PAGE_LIMIT
-                )
+            # the first page is the current response, the rest start from the next offsets
+            for page in range(1, pages_count):
                 yield scrapy.Request(
-                    url=url,
-                    callback=self.parse_items,
-                    meta=response.meta
+                    url=self.list_url(category_id, offset=page * self.PAGE_LIMIT),
+                    callback=self.parse_items
                 )
         else:
             self.logger.info(
@@ -1,180 +1,191 @@
 from datetime import datetime
+from functools import lru_cache
 from typing import Iterable
 
+from psycopg2.extras import execute_batch, execute_values
 
+try:
+    # parses response bytes directly and a few times faster than stdlib json
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
+
+
+# category, tag and color ids repeat over the products
+@lru_cache(maxsize=65536)
 def build_uniqlo_id(site_id: int | str) -> str:
     return f"uniqlo_{site_id}"
 
 
+@lru_cache(maxsize=65536)
 def build_rakuten_id(site_id: int | str) -> str:
     return f"rakuten_{site_id}"
 
 
+def build_rakuten_ids(site_ids: Iterable[int | str]) -> list[str]:
+    return [build_rakuten_id(site_id) for site_id in site_ids]
+
+
 def get_site_id_from_db_id(_id: str) -> str:
-    return _id.split('_')[-1]
+    return _id.rpartition('_')[2]
+
+
+@lru_cache(maxsize=None)
+def site_like_pattern(site: str) -> str:
+    # ids of every site's rows start with the site name
+    return f"{site}%"
 
 
 def product_ids_to_check_count(conn, site: str, check_time: datetime) -> int:
+    # counts each product once, as many active categories as it has
     sql = """
-        SELECT 
-            COUNT(p.id) 
-        FROM products_product AS p
-        LEFT OUTER JOIN products_product_categories AS pc ON p.id = pc.product_id
-        LEFT OUTER JOIN products_category AS c ON pc.category_id = c.id
+        SELECT COUNT(*) FROM products_product AS p
         WHERE 
             p.id like %s 
             AND p.is_active 
-            AND NOT c.deactivated
             AND p.modified_at < %s::timestamp
+            AND EXISTS (
+                SELECT 1 FROM products_product_categories AS pc
+                INNER JOIN products_category AS c ON pc.category_id = c.id
+                WHERE pc.product_id = p.id AND NOT c.deactivated
+            )
         """
     try:
         with conn.cursor() as cur:
-            cur.execute(sql, (f"{site}%", check_time.strftime("%Y-%m-%d %H:%M:%S")))
+            cur.execute(sql, (site_like_pattern(site), check_time))
             return int(cur.fetchone()[0])
     except Exception as e:
         conn.rollback()
         return 0
 
 
-def product_ids_to_check(conn, site: str, check_time: datetime, limit: int, offset: int = 0):
+def product_ids_to_check(conn, site: str, check_time: datetime, limit: int, after_id: str = "") -> list[str]:
     sql = """
-    SELECT DISTINCT ON (p.id) p.id FROM products_product AS p
-    INNER JOIN products_product_categories AS pc ON p.id = pc.product_id
-    INNER JOIN products_category AS c ON pc.category_id = c.id
+    SELECT p.id FROM products_product AS p
     WHERE 
         p.id like %s
         AND p.is_active 
-        AND NOT c.deactivated
         AND p.modified_at < %s::timestamp
-    ORDER BY p.id, p.modified_at ASC
-    LIMIT %s OFFSET %s;
+        AND p.id > %s
+        AND EXISTS (
+            SELECT 1 FROM products_product_categories AS pc
+            INNER JOIN products_category AS c ON pc.category_id = c.id
+            WHERE pc.product_id = p.id AND NOT c.deactivated
+        )
+    ORDER BY p.id
+    LIMIT %s;
     """
     try:
         with conn.cursor() as cur:
-            cur.execute(sql, (f"{site}%", check_time.strftime("%Y-%m-%d %H:%M:%S"), limit, offset))
-            return cur.fetchall()
+            cur.execute(sql, (site_like_pattern(site), check_time, after_id, limit))
+            return [row[0] for row in cur.fetchall()]
     except Exception as e:
         conn.rollback()
         raise e
         # return []
 
 
-def category_ids_for_scrape(conn, site: str):
+def category_ids_for_scrape(conn, site: str) -> set[str]:
+    # the last children of every active level 1 category, found in a single round trip
     sql = """
-    SELECT id FROM products_category 
-    WHERE id like %s AND deactivated = false AND level = 1
+    WITH RECURSIVE tree(id) AS (
+        SELECT id FROM products_category
+        WHERE id LIKE %s AND level = 1 AND NOT deactivated
+        UNION ALL
+        SELECT g.id FROM products_category AS g
+        INNER JOIN tree AS t ON g.parent_id = t.id
+        WHERE g.id LIKE %s AND NOT g.deactivated
+    )
+    SELECT id FROM tree AS c
+    WHERE NOT EXISTS (
+        SELECT 1 FROM products_category AS ch WHERE ch.parent_id = c.id AND NOT ch.deactivated
+    );
     """
+    check_id = site_like_pattern(site)
 
     try:
         with conn.cursor() as cur:
-            cur.execute(sql, (f"{site}%",))
-            base_genre_ids = cur.fetchall()
+            cur.execute(sql, (check_id, check_id))
+            return {row[0] for row in cur.fetchall()}
     except Exception as e:
         conn.rollback()
         raise Exception(f"Failed to retrieve genres for scraping: {e}")
-    else:
-        genre_ids = set()
-        for base_genre_id in base_genre_ids:
-            last_children = set(get_last_children(conn, base_genre_id, site))
-            genre_ids.update(last_children)
-        return genre_ids
 
 
-def get_last_children(conn, current_genre_id, site):
+def get_genres_tree(conn, current_genre_id) -> list[str]:
+    # the category followed by all of its parents up to the root
     sql = """
-    WITH RECURSIVE last_children(id) AS (
-        SELECT id FROM products_category
-        WHERE id like %s AND parent_id = %s AND deactivated = false
-        AND NOT EXISTS (SELECT 1 FROM products_category AS g WHERE g.parent_id = products_category.id)
+    WITH RECURSIVE tree(id, parent_id, depth) AS (
+        SELECT id, parent_id, 0 FROM products_category WHERE id = %s
         UNION ALL
-        SELECT g.id FROM products_category AS g
-        INNER JOIN products_category AS lc ON lc.id = g.parent_id
-        WHERE g.id LIKE %s
+        SELECT c.id, c.parent_id, t.depth + 1 FROM products_category AS c
+        INNER JOIN tree AS t ON c.id = t.parent_id
     )
-    SELECT id FROM last_children;
+    SELECT id FROM tree ORDER BY depth;
     """
-    check_id = f"{site}%"
 
     try:
         with conn.cursor() as cur:
-            cur.execute(sql, (check_id, current_genre_id, check_id))
-            rows = cur.fetchall()
-            last_children = [row[0] for row in rows]
-
+            cur.execute(sql, (current_genre_id,))
+            return [row[0] for row in cur.fetchall()]
     except Exception as e:
         conn.rollback()
-        raise Exception(f"Failed to retrieve last children: {e}")
-
-    return last_children
+        raise Exception(f"Failed to retrieve genres for scraping: {e}")
 
 
-def get_genres_tree(conn, current_genre_id):
-    collected_parents = [current_genre_id]
-    sql = "SELECT parent_id FROM products_category WHERE id = %s"
+def delete_products_exclude_images(conn, images: dict[str, list[str]], page_size: int = 500):
+    # {product_id: [url, ...], ...} deleted in a few round trips instead of one per product
+    sql = "DELETE FROM products_productimage WHERE product_id = %s AND url <> ALL(%s)"
 
     try:
         with conn.cursor() as cur:
-            while True:
-                cur.execute(sql, (current_genre_id,))
-                parent_id = cur.fetchone()
-
-                if not parent_id:
-                    break
-
-                parent_id = parent_id[0]
-                collected_parents.append(parent_id)
-                current_genre_id = parent_id
+            execute_batch(cur, sql, list(images.items()), page_size=page_size)
+        conn.commit()
     except Exception as e:
         conn.rollback()
-        raise Exception(f"Failed to retrieve genres for scraping: {e}")
-    return collected_parents
+        raise Exception(f"Failed to delete product images: {e}")
 
 
-def delete_product_exclude_images(conn, product_id: str, image_urls: list[str]):
-    sql = """
-    DELETE FROM products_productimage AS img
-    WHERE ID IN (
-        SELECT id FROM products_productimage
-        WHERE product_id = %s AND url NOT IN %s
-    )
-    """
+def tag_exists(conn, tag_id) -> bool:
+    return bool(tags_exist(conn, [tag_id]))
 
-    try:
-        with conn.cursor() as cur:
-            cur.execude(sql, (product_id, tuple(image_urls)))
-            cur.commit()
-    except Exception:
-        conn.rollback()
 
+def tags_exist(conn, tag_ids: Iterable[str]) -> set[str]:
+    tag_ids = list(tag_ids)
+    if not tag_ids:
+        return set()
 
-def tag_exists(conn, tag_id):
-    sql = "SELECT EXISTS (SELECT 1 FROM products_tag WHERE id = %s)"
+    sql = "SELECT id FROM products_tag WHERE id = ANY(%s)"
 
     try:
         with conn.cursor() as cur:
-            cur.execute(sql, (tag_id,))
-            return bool(cur.fetchone()[0])
+            cur.execute(sql, (tag_ids,))
+            return {row[0] for row in cur.fetchall()}
     except Exception as e:
         conn.rollback()
-        raise Exception(f"Failed to check tag id to exist {tag_id}: {e}")
+        raise Exception(f"Failed to check tag ids to exist: {e}")
+
 
+def get_product_variation_ids(
+    conn,
+    variations: Iterable[tuple[str, str, str]]
+) -> dict[tuple[str, str, str], str]:
+    variations = list(variations)
+    if not variations:
+        return {}
 
-def get_product_variation_id(conn, category_id, catch_copy, shop_code):
     sql = """
-    SELECT p.id FROM products_product AS p
-    JOIN products_product_categories AS pc ON p.id = pc.product_id
-    JOIN products_category AS c ON pc.category_id = c.id
-    WHERE 
-        c.id = %s 
-        AND p.catch_copy = %s 
-        AND p.shop_code = %s;
+    SELECT DISTINCT ON (v.category_id, v.catch_copy, v.shop_code)
+        v.category_id, v.catch_copy, v.shop_code, p.id
+    FROM (VALUES %s) AS v(category_id, catch_copy, shop_code)
+    JOIN products_product_categories AS pc ON pc.category_id = v.category_id
+    JOIN products_product AS p ON p.id = pc.product_id AND p.catch_copy = v.catch_copy AND p.shop_code = v.shop_code
     """
     try:
         with conn.cursor() as cur:
-            cur.execute(sql, (category_id, catch_copy, shop_code))
-            result = cur.fetchone()
-            return result[0] if result is not None else None
+            rows = execute_values(cur, sql, variations, fetch=True)
+            # {(category_id, catch_copy, shop_code): product_id, ...}
+            return {(category_id, catch_copy, shop_code): _id for category_id, catch_copy, shop_code, _id in rows}
     except Exception as e:
         conn.rollback()
-        raise Exception(f"Failed to get product variation: {e}")
-
+        raise Exception(f"Failed to get product variations: {e}")